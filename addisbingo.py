@@ -5,9 +5,15 @@
 
 import os
 import json
+import queue
+import atexit
+import hashlib
+import asyncio
 import time
 import random
 import logging
+import logging.handlers
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 # --- Python-Telegram-Bot Imports ---
@@ -23,7 +29,13 @@ from telegram.ext import (
 )
 
 # --- Configuration ---
-logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+# Handlers only enqueue records; a listener thread does the actual stream I/O
+log_queue = queue.Queue(-1)
+log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+log_listener.start()
+atexit.register(log_listener.stop)
+logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO,
+                    handlers=[logging.handlers.QueueHandler(log_queue)])
 logger = logging.getLogger(__name__)
 
 # !!! REPLACE WITH YOUR ACTUAL NUMERIC ID !!!
@@ -35,11 +47,20 @@ INITIAL_BALANCE = 1000.0
 MIN_PLAYERS = 2
 GAME_INTERVAL_SECONDS = 300
 CALL_INTERVAL_SECONDS = 15 # Call speed
+SAVE_DELAY_SECONDS = 0.5 # Changes within this window share one state write
+ALLOWED_UPDATES = [Update.MESSAGE] # Only command messages are handled
+
+# Message Templates (HTML; filled with str.format at send time)
+START_MSG = "ሰላም {mention}!\nባላንስዎ: <b>{balance} ብር</b>\nካርድ ለመግዛት: /buycard"
+NO_BALANCE_MSG = "በቂ ሒሳብ የለዎትም። /deposit ይጠቀሙ።"
+CARD_BOUGHT_MSG = "ካርድ ተገዝቷል!\n\n<code>{card}</code>"
+DEPOSIT_MSG = "እባክዎ ወደ 0927922721 ገንዘብ ያስገቡና ደረሰኝዎን ለአድሚን ይላኩ።\nየእርስዎ ID: <code>{user_id}</code>"
 
 # Environment Variables
 TOKEN = os.environ.get("TELEGRAM_TOKEN")
 PORT = int(os.environ.get("PORT", 8080))
 RENDER_URL = os.environ.get("RENDER_EXTERNAL_URL")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") # Defaults to a hash of the token
 
 # Files
 STATE_FILE = "bingo_state.json"
@@ -48,6 +69,10 @@ USER_DATA_FILE = "user_data.json"
 # Global State
 global_state = {}
 user_data_cache = {}
+# Single worker: state writes run one at a time, in submission order
+STATE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state")
+_pending_save = None  # Scheduled flush that has not taken its snapshot yet
+_save_tasks = set()   # Strong refs so running flushes are not garbage collected
 
 # --- Persistence Functions ---
 
@@ -72,23 +97,68 @@ def load_state():
     except Exception as e:
         logger.error(f"Error loading state: {e}")
 
-def save_state():
+def _dump_state():
+    return json.dumps(global_state), json.dumps({str(k): v for k, v in user_data_cache.items()})
+
+def _write_state(state_json, users_json):
     try:
-        with open(STATE_FILE, 'w') as f: json.dump(global_state, f)
-        with open(USER_DATA_FILE, 'w') as f: 
-            json.dump({str(k): v for k, v in user_data_cache.items()}, f)
+        with open(STATE_FILE, 'w') as f: f.write(state_json)
+        with open(USER_DATA_FILE, 'w') as f: f.write(users_json)
     except Exception as e:
         logger.error(f"Error saving state: {e}")
 
+def save_state():
+    _write_state(*_dump_state())
+
+async def save_state_async():
+    """Snapshot state on the event loop, then write the files off it."""
+    payload = _dump_state()
+    await asyncio.get_running_loop().run_in_executor(STATE_EXECUTOR, _write_state, *payload)
+
+async def _flush_state():
+    global _pending_save
+    await asyncio.sleep(SAVE_DELAY_SECONDS)
+    _pending_save = None # Changes from here on schedule a new flush
+    await save_state_async()
+
+def schedule_save():
+    """Persist state soon, batching all changes made within SAVE_DELAY_SECONDS."""
+    global _pending_save
+    if _pending_save is None:
+        _pending_save = asyncio.create_task(_flush_state())
+        _save_tasks.add(_pending_save)
+        _pending_save.add_done_callback(_save_tasks.discard)
+
+async def flush_on_shutdown(app: Application):
+    """Drop pending flushes, wait for any write already running, then save the
+    final state synchronously; that last save replaces the dropped flushes."""
+    global _pending_save
+    for task in list(_save_tasks): task.cancel()
+    _pending_save = None
+    STATE_EXECUTOR.shutdown(wait=True)
+    save_state()
+
 def get_user_data(user_id: int) -> dict:
     if user_id in user_data_cache: return user_data_cache[user_id]
+    # Not saved here: an unsaved default is recreated identically after a
+    # restart, and the next real change (e.g. buycard) persists it.
     default = {'user_id': user_id, 'balance': INITIAL_BALANCE, 'cards': {}}
     user_data_cache[user_id] = default
-    save_state()
     return default
 
+def debit_if_sufficient(user_id: int, cost: float) -> float | None:
+    """Deduct cost in one step; returns the new balance, or None if too low."""
+    data = get_user_data(user_id)
+    if data['balance'] < cost: return None
+    data['balance'] -= cost
+    return data['balance']
+
 # --- Game Logic ---
 
+COLUMNS = ['B', 'I', 'N', 'G', 'O']
+# Display label per cell value (0 = Free Space), built once at import
+CELL_LABELS = ["FB"] + [f"{n:02d}" for n in range(1, 76)]
+
 def generate_card():
     card = {
         'B': random.sample(range(1, 16), 5),
@@ -102,43 +172,39 @@ def generate_card():
     
     # Create matrix
     matrix = []
-    cols = ['B', 'I', 'N', 'G', 'O']
     for r in range(5):
-        matrix.append([card[c][r] for c in cols])
+        matrix.append([card[c][r] for c in COLUMNS])
     return matrix
 
+# Winning lines as 25-bit masks over the card (bit r*5+c for row r, col c)
+WIN_MASKS = tuple(
+    [0x1F << (r * 5) for r in range(5)] +                           # Rows
+    [sum(1 << (r * 5 + c) for r in range(5)) for c in range(5)] +   # Cols
+    [sum(1 << (i * 6) for i in range(5)),                           # Diagonals
+     sum(1 << (i * 4 + 4) for i in range(5))]
+)
+
 def check_bingo(matrix, called):
-    def covered(n): return n == 0 or n in called
-    # Rows
-    for r in matrix:
-        if all(covered(n) for n in r): return True
-    # Cols
-    for c in range(5):
-        if all(covered(matrix[r][c]) for r in range(5)): return True
-    # Diagonals
-    if all(covered(matrix[i][i]) for i in range(5)): return True
-    if all(covered(matrix[i][4-i]) for i in range(5)): return True
-    return False
+    covered = 0
+    for r, row in enumerate(matrix):
+        for c, n in enumerate(row):
+            if n == 0 or n in called: covered |= 1 << (r * 5 + c)
+    return any(covered & m == m for m in WIN_MASKS)
 
 # --- Handlers ---
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     data = get_user_data(user.id)
-    await update.message.reply_html(
-        f"ሰላም {user.mention_html()}!\nባላንስዎ: <b>{data['balance']} ብር</b>\n"
-        f"ካርድ ለመግዛት: /buycard"
-    )
+    await update.message.reply_html(START_MSG.format(mention=user.mention_html(), balance=data['balance']))
 
 async def buycard(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     data = get_user_data(user.id)
     
-    if data['balance'] < GAME_PRICE:
-        await update.message.reply_text("በቂ ሒሳብ የለዎትም። /deposit ይጠቀሙ።")
+    if debit_if_sufficient(user.id, GAME_PRICE) is None:
+        await update.message.reply_text(NO_BALANCE_MSG)
         return
-
-    data['balance'] -= GAME_PRICE
     
     # Register player for current game
     gid = global_state['current_game_id']
@@ -149,17 +215,17 @@ async def buycard(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     global_state['active_players'][str(user.id)] = True
     global_state['total_prize_pool'] += GAME_PRICE
-    save_state()
+    schedule_save()
     
     # Format card for display
     card_str = "B  I  N  G  O\n"
     for row in card:
-        card_str += " ".join(f"{n:02d}" if n!=0 else "FB" for n in row) + "\n"
+        card_str += " ".join(CELL_LABELS[n] for n in row) + "\n"
         
-    await update.message.reply_text(f"ካርድ ተገዝቷል!\n\n`{card_str}`", parse_mode="Markdown")
+    await update.message.reply_html(CARD_BOUGHT_MSG.format(card=card_str))
 
 async def deposit_request(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(f"እባክዎ ወደ 0927922721 ገንዘብ ያስገቡና ደረሰኝዎን ለአድሚን ይላኩ።\nየእርስዎ ID: `{update.effective_user.id}`", parse_mode="Markdown")
+    await update.message.reply_html(DEPOSIT_MSG.format(user_id=update.effective_user.id))
 
 # --- Main Execution ---
 
@@ -169,30 +235,55 @@ def main():
         logger.critical("TELEGRAM_TOKEN not set.")
         return
 
+    # Use uvloop's faster event loop when it is installed
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+
     # Load data
     load_state()
 
     # Create Application
-    app = Application.builder().token(TOKEN).build()
+    app = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(256) # Handle up to 256 updates at once
+        .pool_timeout(5.0)
+        .read_timeout(20.0)
+        .post_shutdown(flush_on_shutdown)
+        .build()
+    )
 
     # Add Handlers
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("buycard", buycard))
-    app.add_handler(CommandHandler("balance", start)) # Re-use start for balance
-    app.add_handler(CommandHandler("deposit", deposit_request))
+    app.add_handlers([
+        CommandHandler("start", start),
+        CommandHandler("buycard", buycard),
+        CommandHandler("balance", start), # Re-use start for balance
+        CommandHandler("deposit", deposit_request),
+    ])
     
     # Webhook vs Polling logic
     if RENDER_URL:
         logger.info(f"Starting Webhook on Port {PORT}")
+        # Telegram echoes the secret in a header, so the path need not carry the token
         app.run_webhook(
             listen="0.0.0.0",
             port=PORT,
-            url_path=TOKEN,
-            webhook_url=f"{RENDER_URL}/{TOKEN}"
+            url_path="tg",
+            webhook_url=f"{RENDER_URL}/tg",
+            secret_token=WEBHOOK_SECRET or hashlib.sha256(TOKEN.encode()).hexdigest()[:32],
+            allowed_updates=ALLOWED_UPDATES
         )
     else:
         logger.info("Starting Polling...")
-        app.run_polling()
+        # Long-poll: one getUpdates request waits up to 30s for new updates
+        app.run_polling(
+            timeout=30,
+            allowed_updates=ALLOWED_UPDATES,
+            drop_pending_updates=True
+        )
 
 if __name__ == "__main__":
     main()